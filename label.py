@@ -1,7 +1,12 @@
 import re
 from six import string_types
 from collections import Counter
-from sage.all import cached_function, ZZ, RR, GCD, ceil, RealField, ComplexField
+from functools import lru_cache, reduce
+from itertools import chain, islice, repeat
+from math import exp, floor, gcd, log, pi
+from multiprocessing import Pool
+from mpmath import digamma
+from sage.all import cached_function, ZZ, RR, CDF, ceil, RealField, ComplexField
 from sage.rings.complex_number import ComplexNumber
 from lmfdb.encoding import LmfdbRealLiteral
 from dirichlet_conrey import DirichletGroup_conrey, DirichletCharacter_conrey
@@ -11,7 +16,85 @@ TYPES = "bigint|text|boolean|numeric|text|boolean|smallint|text|smallint|smallin
 OUTHEADER = "id|origin|primitive|conductor|central_character|self_dual|motivic_weight|Lhash|degree|order_of_vanishing|algebraic|z1|gamma_factors|trace_hash|root_angle|prelabel|analytic_conductor|mu_real|mu_imag|double_nu_real|double_nu_imag|bad_primes".split("|")
 OUTTYPES = "bigint|text|boolean|numeric|text|boolean|smallint|text|smallint|smallint|boolean|numeric|jsonb|bigint|double precision|text|double precision|smallint[]|numeric[]|smallint[]|numeric[]|bigint[]".split("|")
 
-CC_RE = re.compile(r'^(?=[iI.\d+-])([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?(?![iI.\d]))?\s*(?:([+-]?\s*(?:(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)?)?\s*\*?\s*[iI])?$')
+_ZERO = LmfdbRealLiteral(RR, '0')
+_ONE = LmfdbRealLiteral(RR, '1')
+
+CC_RE = re.compile(r'(?=[iI.\d+-])([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?(?![iI.\d]))?\s*(?:([+-]?\s*(?:(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)?)?\s*\*?\s*[iI])?', re.ASCII)
+
+def _squeeze(s):
+    """
+    Remove the whitespace from s, which may only occur at the ends or next to
+    a sign, a * or the i; return None if it sits anywhere else, for example
+    between two digits or inside an exponent.
+    """
+    parts = s.split()
+    for left, right in zip(parts, parts[1:]):
+        if left[-1] not in "+-*iI" and right[0] not in "+-*iI":
+            return None
+        # a sign after e or E belongs to the exponent
+        if left[-1] in "eE" or (left[-1] in "+-" and left[-2:-1] in ("e", "E")):
+            return None
+    return "".join(parts)
+
+def _scan_complex(s):
+    # the fast path of _parse_complex
+    t = _squeeze(s)
+    if t is None:
+        return None
+    if t[-1:] in ("i", "I"):
+        body = t[:-1]
+        if body.endswith("*"):
+            body = body[:-1]
+            if not body:
+                # the * needs a coefficient in front of it
+                return None
+        # find the last sign that does not belong to an exponent
+        k = len(body) - 1
+        while k > 0 and not (body[k] in "+-" and body[k-1] not in "eE"):
+            k -= 1
+        if k > 0:
+            a, b = body[:k], body[k:]
+        else:
+            a, b = "0", body
+        if b in ("", "+"):
+            b = "1"
+        elif b == "-":
+            b = "-1"
+    else:
+        a, b = t, "0"
+    for x in (a, b):
+        if not x or x.strip("+-.0123456789eE"):
+            return None
+        try:
+            float(x)
+        except ValueError:
+            return None
+    return a, b
+
+def _parse_complex(s):
+    """
+    Split a string of the form a+bi, a-bi, bi or a into the strings a and b.
+
+    Missing parts are returned as "0", and a missing coefficient of i as "1" or "-1".
+    """
+    res = _scan_complex(s)
+    if res is None:
+        # The scan accepts every whitespace-free string that CC_RE matches,
+        # so CC_RE only serves as a check that the input is really invalid.
+        t = _squeeze(s)
+        if t is not None and CC_RE.fullmatch(t):
+            raise RuntimeError("'%s' matches CC_RE but was refused by the scan" % s)
+        raise ValueError("'%s' not a valid complex number" % s)
+    return res
+
+@cached_function
+def _CF(prec):
+    return ComplexField(prec)
+
+@cached_function
+def _RF(prec):
+    return RealField(prec)
+
 class ComplexLiteral(ComplexNumber):
     def __init__(self, real, imag=None):
         def find_prec(s):
@@ -29,28 +112,21 @@ class ComplexLiteral(ComplexNumber):
         if imag is None:
             # Process strings
             if isinstance(real, string_types):
-                M = CC_RE.match(real)
-                if M is None:
-                    raise ValueError("'%s' not a valid complex number" % real)
-                a, b = M.groups()
-                # handle missing coefficient of i
-                if b == '-':
-                    b = '-1'
-                elif b in ['+', '']:
-                    b = '1'
+                a, b = _parse_complex(real)
                 # The following is a good guess for the bit-precision,
                 # but we use LmfdbRealLiterals to ensure that our number
                 # prints the same as we got it.
                 prec = max(find_prec(a), find_prec(b), 53)
-                parent = ComplexField(prec)
-                R = parent._real_field()
+                parent = _CF(prec)
+                R = _RF(prec)
                 self._real_literal = LmfdbRealLiteral(R, a)
                 self._imag_literal = LmfdbRealLiteral(R, b)
             elif isinstance(real, LmfdbRealLiteral):
-                parent = ComplexField(real.parent().precision())
+                prec = real.parent().precision()
+                parent = _CF(prec)
                 self._real_literal = real
-                self._imag_literal = parent._real_field()(0)
-            elif isintance(real, ComplexLiteral):
+                self._imag_literal = _RF(prec)(0)
+            elif isinstance(real, ComplexLiteral):
                 parent = real.parent()
                 self._real_literal = real._real_literal
                 self._imag_literal = real._imag_literal
@@ -58,15 +134,15 @@ class ComplexLiteral(ComplexNumber):
                 raise TypeError("Object '%s' of type %s not valid input" % (real, type(real)))
         else:
             prec = max(find_prec(real), find_prec(imag), 53)
-            R = RealField(prec)
-            parent = ComplexField(prec)
+            R = _RF(prec)
+            parent = _CF(prec)
             for x, xname in [(real, '_real_literal'), (imag, '_imag_literal')]:
                 if isinstance(x, string_types):
                     x = LmfdbRealLiteral(R, x)
                 if not isinstance(x, LmfdbRealLiteral):
                     raise TypeError("Object '%s' of type %s not valid input" % (x, type(x)))
                 setattr(self, xname, x)
-        ComplexNumber.__init__(self, self.real(), self.imag())
+        ComplexNumber.__init__(self, parent, self.real(), self.imag())
 
     def real(self):
         return self._real_literal
@@ -95,131 +171,269 @@ class ComplexLiteral(ComplexNumber):
 def CCtuple(z):
     return (z.real(), z.imag().abs(), z.imag())
 
+@lru_cache(maxsize=4096)
+def _spec(prefix, x):
+    return prefix + ("0" if x == 0 else "%.2f" % x)
+
 def spectral_str(x, conjugate=False):
     if conjugate:
         assert x <= 0
-        x = -x
-        res = "c"
-    elif x < 0:
-        x = -x
-        res = "m"
-    else:
-        res = "p"
-    if x == 0:
-        res += "0"
+        prefix = "c"
     else:
-        res += "%.2f" % x
-    return res
+        prefix = "m" if x < 0 else "p"
+    return _spec(prefix, abs(float(x)))
 
-def load(x, H, T):
+def _unknown(H, T):
+    def f(x):
+        raise RuntimeError((x, H, T))
+    return f
+
+def _load_bigint_array(x):
+    return [ZZ(a) for a in x[1:-1].split(",")]
+
+def _load_real(x):
+    # Use LmfdbRealLiteral so that we can get the original string back
+    return LmfdbRealLiteral(RR, x)
+
+def _load_gamma_factors(x):
+    return [[ComplexLiteral(s) for s in piece.strip("[]").split(",") if s] for piece in x[1:-1].replace(" ","").split("],[")]
+
+def pick_loader(H, T):
+    """
+    Return the function parsing the column H of type T from its string form.
+    """
     if T == "text":
-        return x
+        return str
     elif T == "boolean":
-        return True if x == "t" else False
+        return lambda x: x == "t"
     elif T in ["bigint", "smallint"] or H == "conductor":
-        return ZZ(x)
+        return ZZ
     elif T == "bigint[]":
-        return [ZZ(a) for a in x[1:-1].split(",")]
+        return _load_bigint_array
     elif T == "double precision" or H == "z1":
-        # Use LmfdbRealLiteral so that we can get the original string back
-        return LmfdbRealLiteral(RR, x)
+        return _load_real
     elif H == "gamma_factors":
-        return [[CompexLiteral(s) for s in piece[1:-1].split(",")] for piece in x[1:-1].replace(" ","").split("],[")]
+        return _load_gamma_factors
     else:
-        raise RuntimeError((x, H, T))
+        return _unknown(H, T)
+
+@lru_cache(maxsize=8192, typed=True)
+def _repr_cached(a):
+    # typed, since for example 1 and RDF(1) are equal but print differently
+    return repr(a)
+
+def _save_array(x):
+    return "{" + ",".join(map(_repr_cached, x)) + "}"
+
+def _save_gamma_factors(x):
+    return repr(x).replace(" ","")
 
-def save(x, H, T):
+def pick_saver(H, T):
+    """
+    Return the function writing the column H of type T in its string form.
+    """
     if T == "text":
-        return x
+        return str
     elif T == "boolean":
-        return "t" if x else "f"
-    elif T in ["bigint", "smallint"] or H in ["conductor", "mu_imag", "double_nu_imag", "z1"]:
-        return str(x)
+        return lambda x: "t" if x else "f"
+    elif T in ["bigint", "smallint", "double precision"] or H in ["conductor", "z1"]:
+        return str
     elif T in ["smallint[]", "numeric[]", "bigint[]"]:
-        return "{%s}" % (",".join(repr(a) for a in x))
+        return _save_array
     elif H == "gamma_factors":
-        return repr(x).replace(" ","")
+        return _save_gamma_factors
     else:
-        raise RuntimeError((x, H, T))
+        return _unknown(H, T)
 
-def process_line(line):
-    L = {H: load(x, H, T) for (x, H, T) in zip(line.split("|"), HEADER, TYPES)}
-    L["central_character"] = primitivize(L["central_character"])
+LOADERS = [pick_loader(H, T) for (H, T) in zip(HEADER, TYPES)]
+SAVERS = [pick_saver(H, T) for (H, T) in zip(OUTHEADER, OUTTYPES)]
+
+class _Row(object):
+    """
+    The fields of one row, stored as attributes named after OUTHEADER.
+    """
+    # gr_real and gc_real hold the unrounded real parts of the shifts, set by make_label
+    __slots__ = tuple(OUTHEADER) + ("gr_real", "gc_real")
+
+    def __init__(self, values):
+        for H, x in zip(HEADER, values):
+            setattr(self, H, x)
+
+def _complete_row(L):
+    L.central_character = primitivize(L.central_character)
     make_label(L) # also sets mus and nus
-    L["analytic_conductor"] = analytic_conductor(L[)
-    return "|".join(save(L[H], H, T) for (H, T) in zip(OUTHEADER, OUTTYPES))
+    L.bad_primes = L.conductor.prime_divisors()
+    L.analytic_conductor = analytic_conductor(L)
+
+def finish_row(L):
+    _complete_row(L)
+    return "|".join(saver(getattr(L, H)) for (H, saver) in zip(OUTHEADER, SAVERS))
+
+def _load_row(line):
+    return _Row([loader(x) for (loader, x) in zip(LOADERS, line.split("|"))])
+
+def process_line(line):
+    return finish_row(_load_row(line))
+
+def process_line_to(buf, line):
+    """
+    Append the output for line, followed by a newline, to the bytearray buf.
+
+    This avoids building the output line as a string, so that callers can
+    write out a whole batch of lines at once.
+    """
+    L = _load_row(line)
+    _complete_row(L)
+    for H, saver in zip(OUTHEADER, SAVERS):
+        buf.extend(saver(getattr(L, H)).encode())
+        buf.append(0x7C) # |
+    buf[-1] = 0x0A # replace the trailing | by a newline
+
+def process_chunk(lines):
+    """
+    Process a batch of lines, returning the list of output lines.
+
+    The input is split and loaded one column at a time; only the label
+    computation is done row by row.
+    """
+    columns = zip(*[line.split("|") for line in lines])
+    loaded = [list(map(loader, col)) for (col, loader) in zip(columns, LOADERS)]
+    return [finish_row(_Row(row)) for row in zip(*loaded)]
+
+def _process_batch(lines):
+    buf = bytearray()
+    for line in lines:
+        process_line_to(buf, line.rstrip("\n"))
+    return buf
+
+def _batches(F, size):
+    while True:
+        batch = list(islice(F, size))
+        if not batch:
+            return
+        yield batch
+
+def process_file(in_path, out_path, workers=None, chunksize=2000):
+    """
+    Process each line of in_path, writing the results in order to out_path.
+
+    Batches of chunksize lines are handed out to a pool of worker processes
+    (by default one per cpu), each of which returns the output of its batch
+    as bytes, written with a single call; each worker keeps its own caches
+    across the lines it processes.
+    """
+    if chunksize < 1:
+        raise ValueError("chunksize must be positive, not %s" % chunksize)
+    with open(in_path) as Fin, open(out_path, "wb") as Fout:
+        with Pool(workers) as pool:
+            for buf in pool.imap(_process_batch, _batches(Fin, chunksize)):
+                Fout.write(buf)
 
 @cached_function
 def DirGroup(m):
     return DirichletGroup_conrey(m)
 
 @cached_function
-def primitivize(label):
-    m, n = [ZZ(a) for a in label.split(".")]
+def _prim_mn(m, n):
     char = DirichletCharacter_conrey(DirGroup(m), n).primitive_character()
-    return "%d.%d" % (char.modulus(), char.number())
+    return char.modulus(), char.number()
+
+@cached_function
+def primitivize(label):
+    m, _, n = label.partition(".")
+    return "%d.%d" % _prim_mn(ZZ(int(m)), ZZ(int(n)))
+
+def _round(x):
+    # ties away from zero, matching Sage's round; the subtraction is exact
+    a = abs(x)
+    r = floor(a)
+    if a - r >= 0.5:
+        r += 1
+    return r if x >= 0 else -r
+
+def _label_gammas(gr_real, gr_imag, gc_real, gc_imag, algebraic):
+    """
+    The part of the prelabel after the central character, computed from the
+    real and imaginary parts of the sorted gamma_R and gamma_C shifts.
+    """
+    # a nonempty list without repeats has a multiplicity 1, forcing ge = 1
+    if any(G and len(set(G)) == len(G) for G in [gr_real, gc_real]):
+        ge = 1
+    else:
+        GRcount = Counter(gr_real)
+        GCcount = Counter(gc_real)
+        ge = reduce(gcd, chain(GRcount.values(), GCcount.values()), 0)
+    if ge > 1:
+        rs_real = list(chain.from_iterable(repeat(k, v//ge) for k, v in GRcount.items()))
+        cs_real = list(chain.from_iterable(repeat(k, v//ge) for k, v in GCcount.items()))
+    else:
+        rs_real, cs_real = gr_real, gc_real
+
+    parts = ["-"]
+    parts.extend('r%d' % _round(x) for x in rs_real)
+    parts.extend('c%d' % _round(2*x) for x in cs_real)
+    if ge > 1:
+        parts.append("e%d" % ge)
+    if algebraic:
+        parts.append("-0")
+    else:
+        parts.append("-")
+        for real, imag in [(gr_real, gr_imag), (gc_real, gc_imag)]:
+            n = len(real)
+            for i in range(n):
+                conjugate = False
+                if imag[i] <= 0 and i < n - 1 and real[i] == real[i + 1] and -imag[i] == imag[i + 1]:
+                    conjugate = True
+                elif imag[i] >= 0 and i > 0 and real[i] == real[i - 1] and -imag[i] == imag[i - 1]:
+                    # we already listed this one as a conjugate
+                    continue
+                parts.append(spectral_str(imag[i], conjugate=conjugate))
+    return "".join(parts)
 
 def make_label(L):
-    GR, GC = L['gamma_factors']
-    analytic_normalization = L['motivic_weight']/2
+    GR, GC = L.gamma_factors
+    analytic_normalization = L.motivic_weight/2
     GR = [CDF(elt) + analytic_normalization for elt in GR]
     GC = [CDF(elt) + analytic_normalization for elt in GC]
-    b, e = L['conductor'].perfect_power()
+    b, e = L.conductor.perfect_power()
     if e == 1:
         conductor = b
     else:
         conductor = "{}e{}".format(b, e)
-    beginning = "-".join(map(str, [L['degree'], conductor, L['central_character']]))
+    beginning = "-".join(map(str, [L.degree, conductor, L.central_character]))
 
-    GRcount = Counter(GR)
-    GCcount = Counter(GC)
     # convert gamma_R to gamma_C
-    zero = LmfdbRealLiteral(RR, '0')
-    one = LmfdbRealLiteral(RR, '1')
-    while GRcount[zero] > 0 and GRcount[one] > 0:
-        GCcount[zero] += 1
-        GRcount[zero] -= 1
-        GRcount[one] -= 1
-    GR = sum([[m]*c for m, c in GRcount.items()], [])
-    GC = sum([[m]*c for m, c in GCcount.items()], [])
-    assert L['degree'] == len(GR) + 2*len(GC)
+    if _ZERO in GR and _ONE in GR:
+        for _ in range(min(GR.count(_ZERO), GR.count(_ONE))):
+            GC.append(GR.pop(GR.index(_ZERO)))
+            GR.remove(_ONE)
+    assert L.degree == len(GR) + 2*len(GC)
     GR.sort(key=CCtuple)
     GC.sort(key=CCtuple)
 
-    L["mu_imag"] = [elt.imag() for elt in GR]
-    L["double_nu_imag"] = [2*elt.imag() for elt in GC]
-
-    # deal with real parts
-    GR_real = [elt.real() for elt in GR]
-    GC_real = [elt.real() for elt in GC]
-    L["mu_real"] = [x.round() for x in GR_real]
-    L["double_nu_real"] = [(2*x).round() for x in GC_real]
-    GRcount = Counter(GR_real)
-    GCcount = Counter(GC_real)
-    ge = GCD(GCD(list(GRcount.values())), GCD(list(GCcount.values())))
-    if ge > 1:
-        GR_real = sum(([k]*(v//ge) for k, v in GRcount.items()), [])
-        GC_real = sum(([k]*(v//ge) for k, v in GCcount.items()), [])
+    L.mu_imag = [elt.imag() for elt in GR]
+    L.double_nu_imag = [2*elt.imag() for elt in GC]
 
-    rs = ''.join(['r%d' % elt.real().round() for elt in GR_real])
-    cs = ''.join(['c%d' % (elt.real()*2).round() for elt in GC_real])
-    gammas = "-" + rs + cs
-    if ge > 1:
-        gammas += "e%d" % ge
-    if L['algebraic']:
-        end = "-0"
-    else:
-        end = "-"
-        for G in [GR, GC]:
-            for i, elt in enumerate(G):
-                conjugate = False
-                if elt.imag() <= 0 and i < len(G) - 1 and elt.conjugate() == G[i + 1]:
-                    conjugate = True
-                elif elt.imag() >= 0 and i > 0 and elt.conjugate() == G[i - 1]:
-                    # we already listed this one as a conjugate
-                    continue
-                end += spectral_str(elt.imag(), conjugate=conjugate)
-    L["prelabel"] = beginning + gammas + end
+    # the real parts and the rest of the label only need the shifts as floats
+    L.gr_real = gr_real = [float(elt.real()) for elt in GR]
+    L.gc_real = gc_real = [float(elt.real()) for elt in GC]
+    L.mu_real = [_round(x) for x in gr_real]
+    L.double_nu_real = [_round(2*x) for x in gc_real]
+    L.prelabel = beginning + _label_gammas(gr_real,
+                                           [float(elt.imag()) for elt in GR],
+                                           gc_real,
+                                           [float(elt.imag()) for elt in GC],
+                                           L.algebraic)
 
 def analytic_conductor(L):
-    
+    """
+    The analytic conductor at s = 1/2, computed from the gamma shifts set by make_label.
+
+    The real parts are taken unrounded, so non-integral shifts are handled correctly.
+    """
+    res = log(int(L.conductor))
+    for x, y in zip(L.gr_real, L.mu_imag):
+        res += digamma(complex(0.5 + x, float(y)) / 2).real - log(pi)
+    for x, y in zip(L.gc_real, L.double_nu_imag):
+        res += 2*digamma(complex(0.5 + x, float(y)/2)).real - 2*log(2*pi)
+    return exp(res)